@@ -1,16 +1,22 @@
-from flask import Response, Flask
+from flask import Response, Flask, request
 from flask.helpers import send_from_directory
 from flask_restful import Api, Resource, reqparse
 from flask_cors import CORS
 from src.main import ImageProcessor, format_data
-import cv2
+from src.StreamVariants import EncodedFrameCache, AdaptiveVariant, parseVariant
+from src.DetectionLog import DetectionLog
+from src.Camera import Camera
 import threading
 import time
+import traceback
 
-frame = None
-lock = threading.Lock()
+frames = EncodedFrameCache()
+capture_thread = None
+capture_lock = threading.Lock()
+camera = None
 data = None
-ip = ImageProcessor()
+detectionLog = DetectionLog()
+ip = ImageProcessor(detectionLog, "camera0-flask")
 AR = False
 
 class VideoApiHandler(Resource):
@@ -28,49 +34,89 @@ class VideoApiHandler(Resource):
             AR = False
         return {'resultStatus': 'SUCCESS', 'data': data if data else "No code detected", 'url': format_data(data) if data else ""}
 
+class DetectionApiHandler(Resource):
+    def get(self):
+        return detectionLog.api(request.args)
+
 app = Flask(__name__, static_url_path='', static_folder='frontend/public')
 CORS(app)
 api = Api(app)
 
 api.add_resource(VideoApiHandler, '/flask/video_feed')
-
-vc = cv2.VideoCapture(0)
-
-if not vc.isOpened():
-        print("Error: Unable to open camera")
+api.add_resource(DetectionApiHandler, '/flask/detections')
 
 @app.route('/')
 def index():
     return send_from_directory(app.static_folder, 'index.html')
 
 def detect_codes():
-    global frame, lock, data
-    while True:
-        isRead, frame = vc.read()
-        if not isRead:
-            break
-        processed, codeExists, data = ip.processImage(frame, AR)
-        with lock:
-            frame = processed.copy()
-        time.sleep(0.1)
+    global data, camera, capture_thread
+    try:
+        # The camera is opened by each capture thread, so a restarted thread gets a fresh camera.
+        camera = Camera(0)
+        if not camera.isOpened():
+            print("Error: Unable to open camera")
+            return
+        while True:
+            captured = camera.read()
+            if captured is None:
+                print("Error: Unable to read from camera")
+                break
+            # Display boxes are recorded in an overlay instead of being drawn onto the
+            # captured frame, so the frame can be shared with the encoder without a copy.
+            result = ip.process(captured, AR)
+            data = result.tracks[0].data if result.tracks else None
+            frames.publish(result.frame, result.overlay)
+            time.sleep(0.1)
+    except Exception:
+        print("Error: Capture stopped")
+        traceback.print_exc()
+    finally:
+        if camera is not None:
+            camera.release()
+        # Viewers of the stopped capture are disconnected, and the next viewer starts a new thread.
+        with capture_lock:
+            if capture_thread is threading.current_thread():
+                capture_thread = None
+            frames.close()
 
-def encode_frame():
-    global frame, lock
+def encode_frame(variant, adaptive):
+    controller = AdaptiveVariant() if adaptive else None
+    seq = 0
+    sendStart = 0
     while True:
-        with lock:
-            if frame is None:
-                continue
-            flag, encodedFrame = cv2.imencode(".jpg", frame)
-            if not flag:
-                continue
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encodedFrame) + b'\r\n')
+        current = controller.variant if controller else variant
+        # Frames are not sent faster than the variant's maximum frame rate.
+        delay = sendStart + 1.0 / current.maxFps - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if not frames.wait(seq, 1.0):
+            continue
+        if frames.closed:
+            # Capture stopped, so the stream is ended instead of left waiting.
+            return
+        seq, encodedFrame = frames.get(current)
+        if encodedFrame is None:
+            continue
+        sendStart = time.time()
+        yield encodedFrame
+        # The generator resumes once the server has written the chunk, so a long
+        # pause here means the viewer's send buffer is backing up.
+        if controller:
+            controller.report(time.time() - sendStart)
 
 def start_thread():
-    t = threading.Thread(target=detect_codes)
-    t.daemon = True
-    t.start()
+    global capture_thread
+    # The engine keeps state between frames, so only one capture thread may run.
+    with capture_lock:
+        if capture_thread is None or not capture_thread.is_alive():
+            frames.open()
+            capture_thread = threading.Thread(target=detect_codes)
+            capture_thread.daemon = True
+            capture_thread.start()
 
 @app.route("/video_feed")
 def video_feed():
     start_thread()
-    return Response(encode_frame(), mimetype = "multipart/x-mixed-replace; boundary=frame")
\ No newline at end of file
+    variant, adaptive = parseVariant(request.args)
+    return Response(encode_frame(variant, adaptive), mimetype = "multipart/x-mixed-replace; boundary=frame")
\ No newline at end of file
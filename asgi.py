@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from src.main import ImageProcessor, format_data
+from src.StreamVariants import AdaptiveVariant, parseVariant, encodingKey, encodeVariant
+from src.BufferPool import BufferPool
+from src.DetectionLog import DetectionLog
+from src.Camera import Camera
+
+# Asyncio server mode. Serves the same /video_feed MJPEG stream and /flask/video_feed
+# JSON API as app.py, but each viewer is a coroutine instead of a worker thread,
+# so one process can hold thousands of idle or slow viewers.
+# Run with: python asgi.py  (or: uvicorn asgi:app --port 5000)
+
+static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend', 'public')
+
+# Camera reads and code detection share ImageProcessor state, so they run on a single thread.
+capture_executor = ThreadPoolExecutor(max_workers=1)
+# JPEG encoding releases the GIL and runs on its own threads.
+encode_executor = ThreadPoolExecutor(max_workers=2)
+
+# Seconds a single chunk may take to reach a viewer before the connection is dropped.
+send_timeout = 30
+
+detectionLog = DetectionLog()
+ip = ImageProcessor(detectionLog, "camera0-asgi")
+framePool = BufferPool()
+camera = None
+data = None
+AR = False
+
+# Holds the latest frame encoded for one stream variant. Viewers only ever keep
+# a reference to the newest frame, so a slow viewer skips frames instead of queueing them.
+class FrameChannel:
+    def __init__(self, variant):
+        self.variant = variant
+        self.seq = 0
+        self.jpeg = None
+        self.viewers = 0
+        self.closed = False
+        self.published = asyncio.Event()
+
+    def publish(self, seq, jpeg):
+        self.seq = seq
+        self.jpeg = jpeg
+        published, self.published = self.published, asyncio.Event()
+        published.set()
+
+    # Wakes up every viewer and tells it that no more frames will be published.
+    def close(self):
+        self.closed = True
+        self.published.set()
+
+    # Waits until a frame newer than seq is available.
+    # @param seq The sequence number of the last frame the viewer received.
+    # @return The sequence number and bytes of the newest frame, or None for the bytes if the channel was closed.
+    async def next(self, seq):
+        # Viewers that switch channels carry over the sequence number of the last
+        # frame they received, so older frames on the new channel are skipped too.
+        while self.jpeg is None or self.seq <= seq:
+            if self.closed:
+                return seq, None
+            await self.published.wait()
+        return self.seq, self.jpeg
+
+# One channel per encoding key. Every frame is encoded once for each channel with viewers.
+channels = {}
+capture_task = None
+
+def subscribe(variant):
+    # Capture is restarted here if it stopped, so every new subscriber gets frames.
+    start_capture()
+    channel = channels.get(encodingKey(variant))
+    if channel is None:
+        channel = channels[encodingKey(variant)] = FrameChannel(variant)
+    channel.viewers += 1
+    return channel
+
+def unsubscribe(channel):
+    channel.viewers -= 1
+    if channel.viewers == 0 and channels.get(encodingKey(channel.variant)) is channel:
+        del channels[encodingKey(channel.variant)]
+
+def open_camera():
+    global camera
+    camera = Camera(0)
+    if not camera.isOpened():
+        print("Error: Unable to open camera")
+
+def process_next_frame():
+    global data
+    captured = camera.read()
+    if captured is None:
+        return None
+    result = ip.process(captured, AR)
+    data = result.tracks[0].data if result.tracks else None
+    return result.frame, result.overlay
+
+async def detect_codes():
+    global capture_task
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(capture_executor, open_camera)
+        seq = 0
+        while True:
+            result = await loop.run_in_executor(capture_executor, process_next_frame)
+            if result is None:
+                print("Error: Unable to read from camera")
+                break
+            seq += 1
+            # Frames are only composed and encoded while someone is watching.
+            active = list(channels.values())
+            if active:
+                frame, overlay = result
+                composed = await loop.run_in_executor(encode_executor, overlay.compose, frame, framePool.next("composed", frame.shape))
+                encoded = await asyncio.gather(*[loop.run_in_executor(encode_executor, encodeVariant, composed, c.variant) for c in active])
+                for c, jpeg in zip(active, encoded):
+                    if jpeg is not None:
+                        c.publish(seq, jpeg)
+            await asyncio.sleep(0.1)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        print("Error: Capture stopped")
+        traceback.print_exc()
+    finally:
+        # Viewers of the stopped capture are disconnected, and the next viewer starts
+        # a new capture, which opens the camera again.
+        if capture_task is asyncio.current_task():
+            capture_task = None
+        for c in list(channels.values()):
+            c.close()
+        channels.clear()
+        if camera is not None:
+            await loop.run_in_executor(capture_executor, camera.release)
+
+def start_capture():
+    global capture_task
+    if capture_task is None:
+        capture_task = asyncio.get_running_loop().create_task(detect_codes())
+
+async def stop_capture():
+    task = capture_task
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+def api_response():
+    return {'resultStatus': 'SUCCESS', 'data': data if data else "No code detected", 'url': format_data(data) if data else ""}
+
+cors_headers = [(b'access-control-allow-origin', b'*'),
+                (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                (b'access-control-allow-headers', b'Content-Type')]
+
+async def send_response(send, status, body, content_type):
+    headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())] + cors_headers
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+# Reads the AR argument from either a JSON or a form-encoded body, as reqparse does.
+def parse_ar(body, content_type):
+    if content_type.startswith(b'application/json'):
+        try:
+            args = json.loads(body or b'{}')
+        except ValueError:
+            args = {}
+        setAR = args.get('AR') if isinstance(args, dict) else None
+    else:
+        setAR = parse_qs(body.decode('latin-1')).get('AR', [None])[0]
+    return setAR == "True"
+
+async def video_api(scope, receive, send):
+    global AR
+    if scope['method'] == 'OPTIONS':
+        await send_response(send, 200, b'', b'text/plain')
+        return
+    if scope['method'] == 'POST':
+        body = await read_body(receive)
+        if body is None:
+            return
+        content_type = dict(scope['headers']).get(b'content-type', b'')
+        AR = parse_ar(body, content_type)
+    elif scope['method'] != 'GET':
+        await send_response(send, 405, b'Method Not Allowed', b'text/plain')
+        return
+    await send_response(send, 200, json.dumps(api_response()).encode(), b'application/json')
+
+async def detections_api(scope, receive, send):
+    if scope['method'] == 'OPTIONS':
+        await send_response(send, 200, b'', b'text/plain')
+        return
+    args = {k: v[0] for k, v in parse_qs(scope['query_string'].decode('latin-1')).items()}
+    # Queries read SQLite, so they run off the event loop.
+    result = await asyncio.get_running_loop().run_in_executor(None, detectionLog.api, args)
+    await send_response(send, 200, json.dumps(result).encode(), b'application/json')
+
+async def video_feed(scope, receive, send):
+    variant, adaptive = parseVariant({k: v[0] for k, v in parse_qs(scope['query_string'].decode('latin-1')).items()})
+    controller = AdaptiveVariant() if adaptive else None
+    stream = asyncio.current_task()
+
+    # The stream never reads the request body, so disconnects are watched for separately.
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        stream.cancel()
+
+    watcher = asyncio.get_running_loop().create_task(watch_disconnect())
+    channel = subscribe(controller.variant if controller else variant)
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame'),
+                                (b'cache-control', b'no-cache')] + cors_headers})
+        seq = 0
+        while True:
+            seq, jpeg = await channel.next(seq)
+            if jpeg is None:
+                # Capture stopped, so the stream is ended instead of left waiting.
+                await send({'type': 'http.response.body', 'body': b''})
+                break
+            sendStart = time.monotonic()
+            # send() waits on the transport's flow control, so a viewer with a full
+            # send buffer holds at most this one frame.
+            await asyncio.wait_for(send({'type': 'http.response.body', 'body': jpeg, 'more_body': True}), send_timeout)
+            elapsed = time.monotonic() - sendStart
+            if controller and controller.report(elapsed):
+                unsubscribe(channel)
+                channel = subscribe(controller.variant)
+            # Frames are not sent faster than the variant's maximum frame rate.
+            delay = 1.0 / channel.variant.maxFps - elapsed
+            if delay > 0:
+                await asyncio.sleep(delay)
+    except (asyncio.CancelledError, asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        unsubscribe(channel)
+        watcher.cancel()
+
+async def index(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    with open(os.path.join(static_folder, 'index.html'), 'rb') as f:
+        body = await loop.run_in_executor(None, f.read)
+    await send_response(send, 200, body, b'text/html; charset=utf-8')
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_capture()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await stop_capture()
+            await asyncio.get_running_loop().run_in_executor(None, detectionLog.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+routes = {
+    '/': index,
+    '/video_feed': video_feed,
+    '/flask/video_feed': video_api,
+    '/flask/detections': detections_api,
+}
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    handler = routes.get(scope['path'])
+    if handler is None:
+        await send_response(send, 404, b'Not Found', b'text/plain')
+        return
+    await handler(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
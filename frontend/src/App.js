@@ -37,7 +37,7 @@ function App() {
         <button onClick={() => setAR(!getAR)}>
           {getAR ? "Turn off AR" : "Turn on AR"}
         </button>
-      <img src='http://localhost:5000/video_feed' className="App-logo" alt="logo" />
+      <img src='http://localhost:5000/video_feed?variant=auto' className="App-logo" alt="logo" />
         <p>
           Video Feed
         </p>
@@ -0,0 +1,80 @@
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from src.main import ImageProcessor, makeARPreviewFrame
+from src.BufferPool import BufferPool
+
+# Measures the steady-state memory used per frame by code tracking, AR previews and
+# overlay composition at several resolutions. NumPy and OpenCV arrays are traced by
+# tracemalloc, so "retained" shows memory that grows with the number of frames and
+# "peak" shows the largest amount allocated at once while processing a frame.
+# Run with: python memory_benchmark.py [frames]
+
+resolutions = [(640, 480), (1280, 720), (1920, 1080)]
+warmupFrames = 10
+
+# Builds two slightly shifted noise frames, so optical flow has texture to follow.
+def makeFrames(width, height):
+    rng = np.random.default_rng(0)
+    base = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (5, 5), 0)
+    return [base, np.roll(base, 2, axis=1)]
+
+# Puts the processor in the state it is in right after a code has been detected, so
+# every frame runs the optical flow and rectified re-decode path.
+def startTracking(ip, frame, width, height):
+    ip.keepHistory(ip.grayscale(frame))
+    w, h = width // 8, height // 8
+    x, y = width // 2 - w // 2, height // 2 - h // 2
+    ip.qrExists = True
+    ip.lastSeen = time.time() + 3600
+    ip.prevPoints = [[[x, y], [x, y + h], [x + w, y + h], [x + w, y]]]
+    ip.prevData = ["https://example.com/a/long/path/that/needs/to/be/truncated/for/display"]
+    ip.prevText = ["QRCODE: " + ip.prevData[0]]
+    ip.prevTrackIds = [0]
+
+def measure(step, frames):
+    for i in range(warmupFrames):
+        step(i)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for i in range(frames):
+        step(i)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current - before, peak - before
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    previewPath = os.path.join(tempfile.mkdtemp(), "preview.png")
+    cv2.imwrite(previewPath, np.full((200, 600, 3), 255, dtype=np.uint8))
+
+    print("{:>10} {:>10} {:>14} {:>14} {:>12}".format("resolution", "stage", "retained (KB)", "peak (KB)", "frame (KB)"))
+    for width, height in resolutions:
+        source = makeFrames(width, height)
+        ip = ImageProcessor()
+        pool = BufferPool()
+        startTracking(ip, source[0], width, height)
+        overlays = {}
+
+        def track(i):
+            overlays["last"] = ip.process(source[i % 2]).overlay
+
+        def preview(i):
+            out = pool.next("ar", source[0].shape)
+            makeARPreviewFrame(source[i % 2], ip.prevPoints[0], previewPath, width, height, out)
+
+        def compose(i):
+            overlays["last"].compose(source[i % 2], pool.next("composed", source[0].shape))
+
+        for name, step in [("track", track), ("AR", preview), ("compose", compose)]:
+            retained, peak = measure(step, frames)
+            print("{:>10} {:>10} {:>14.1f} {:>14.1f} {:>12.1f}".format(
+                "{}x{}".format(width, height), name, retained / 1024, peak / 1024, source[0].nbytes / 1024))
+
+if __name__ == '__main__':
+    main()
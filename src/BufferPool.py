@@ -0,0 +1,48 @@
+import threading
+import numpy as np
+
+# Number of buffers in a ring of frames that are handed to other threads. A frame
+# is only overwritten after this many newer frames have been produced.
+frameRingDepth = 4
+
+# A pool of preallocated arrays that are reused across frames, so the steady-state
+# allocation rate does not grow with the frame resolution. Arrays are only
+# reallocated when the requested shape or type changes.
+class BufferPool:
+
+    # Initializes the BufferPool class with no buffers.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.counters = {}
+
+    # Returns the buffer stored under key, allocating it if needed.
+    # @param key A hashable name for the buffer.
+    # @param shape A tuple storing the shape of the buffer.
+    # @param dtype The NumPy type of the buffer.
+    # @return A NumPy array of the given shape and type. Its contents are undefined.
+    def get(self, key, shape, dtype = np.uint8):
+        shape = tuple(shape)
+        with self.lock:
+            buf = self.buffers.get(key)
+            if buf is None or buf.shape != shape or buf.dtype != dtype:
+                buf = self.buffers[key] = np.empty(shape, dtype)
+            return buf
+
+    # Returns the next buffer of a ring of buffers stored under key. Used for frames
+    # that other threads may still be reading while the next frame is produced.
+    # @param key A hashable name for the ring.
+    # @param shape A tuple storing the shape of each buffer.
+    # @param depth The number of buffers in the ring.
+    # @param dtype The NumPy type of each buffer.
+    # @return A NumPy array of the given shape and type. Its contents are undefined.
+    def next(self, key, shape, depth = frameRingDepth, dtype = np.uint8):
+        with self.lock:
+            i = self.counters.get(key, 0)
+            self.counters[key] = (i + 1) % depth
+        return self.get((key, i), shape, dtype)
+
+    # Returns the total number of bytes held by the pool.
+    def nbytes(self):
+        with self.lock:
+            return sum(buf.nbytes for buf in self.buffers.values())
@@ -0,0 +1,31 @@
+import cv2
+from .BufferPool import BufferPool
+
+# Reads frames from a camera into a ring of pooled buffers instead of allocating
+# a new array per frame. Shared by the desktop application and the web servers.
+class Camera:
+
+    # Opens the camera.
+    # @param index The index of the camera, 0 for the default camera.
+    def __init__(self, index = 0):
+        self.vidCap = cv2.VideoCapture(index)
+        self.pool = BufferPool()
+        self.shape = (int(self.vidCap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.vidCap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+
+    # Returns True if the camera was opened.
+    def isOpened(self):
+        return self.vidCap.isOpened()
+
+    # Reads the next frame. The frame stays valid until frameRingDepth newer frames have been read.
+    # @return The frame, or None if no frame could be read.
+    def read(self):
+        isRead, frame = self.vidCap.read(self.pool.next("capture", self.shape))
+        if not isRead:
+            return None
+        # The camera may deliver a different size than it reports.
+        self.shape = frame.shape
+        return frame
+
+    # Closes the camera.
+    def release(self):
+        self.vidCap.release()
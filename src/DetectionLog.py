@@ -0,0 +1,251 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+from collections import OrderedDict, namedtuple
+
+# A detection of one code on one track. A track keeps its ID while the same code
+# stays in view, so each record covers the time between its first and last decode.
+# @param polygon A sample of the points of the code, taken when it was first seen.
+DetectionRecord = namedtuple('DetectionRecord', ['stream', 'trackId', 'payload', 'codeType', 'firstSeen', 'lastSeen', 'polygon'])
+
+schema = '''
+CREATE TABLE IF NOT EXISTS detections (
+    stream TEXT NOT NULL,
+    trackId INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    codeType TEXT NOT NULL,
+    firstSeen REAL NOT NULL,
+    lastSeen REAL NOT NULL,
+    polygon TEXT NOT NULL,
+    UNIQUE (stream, trackId, payload)
+);
+CREATE INDEX IF NOT EXISTS detectionsByTime ON detections (firstSeen, lastSeen);
+'''
+
+# Named bucket sizes accepted by uniquePayloads, in seconds.
+buckets = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+# An append-only, time-indexed log of detections. Recent records are kept in an
+# in-memory ring buffer and flushed to SQLite periodically. Recording a detection
+# only puts it on a queue, so the frame thread never waits for the database.
+class DetectionLog:
+
+    # Initializes the DetectionLog class and starts its writer thread.
+    # @param dbPath The path of the SQLite database. ":memory:" keeps the log in memory.
+    # @param capacity The maximum number of records kept in memory.
+    # @param flushInterval The number of seconds between writes to the database.
+    # @param queueSize The maximum number of detections waiting for the writer thread. Detections
+    # recorded while the queue is full are dropped and counted in self.dropped.
+    def __init__(self, dbPath = 'detections.db', capacity = 10000, flushInterval = 5.0, queueSize = 10000):
+        self.capacity = capacity
+        self.flushInterval = flushInterval
+        self.queue = queue.Queue(queueSize)
+        self.dropped = 0
+        self.stopping = False
+        # Records by (stream, trackId, payload), oldest first.
+        self.records = OrderedDict()
+        # Keys of records that changed since the last flush.
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbPath, check_same_thread=False)
+        self.db.executescript(schema)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Returns a track ID that has not been used on the given stream, including by
+    # earlier runs that wrote to the same database.
+    # @param stream A string naming the camera or stream.
+    # @return The integer one greater than the largest track ID logged for the stream.
+    def nextTrackId(self, stream):
+        with self.lock:
+            ids = [k[1] for k in self.records if k[0] == stream]
+            row = self.db.execute('SELECT MAX(trackId) FROM detections WHERE stream = ?', (stream,)).fetchone()
+        if row[0] is not None:
+            ids.append(row[0])
+        return max(ids) + 1 if ids else 0
+
+    # Records that a code was decoded. Safe to call from the frame thread.
+    # @param stream A string naming the camera or stream the code was seen on.
+    # @param trackId The integer ID of the track the code belongs to.
+    # @param payload The string data retrieved from the code.
+    # @param codeType The type of the code, for example "QRCODE".
+    # @param polygon A 2d array containing the coordinates for each of the points of the code.
+    # @param timestamp The time the code was seen. Defaults to now.
+    def record(self, stream, trackId, payload, codeType, polygon, timestamp = None):
+        try:
+            self.queue.put_nowait((stream, trackId, payload, codeType, [[int(p[0]), int(p[1])] for p in polygon],
+                                   time.time() if timestamp is None else timestamp))
+        except queue.Full:
+            # The writer thread is behind, so the detection is dropped rather than blocking the frame thread.
+            self.dropped += 1
+            if self.dropped == 1:
+                print("Error: Detection log queue is full, dropping detections")
+
+    # Merges queued detections into the ring buffer and flushes it every flushInterval seconds.
+    # Database errors are logged and the changed records are kept, so the next flush retries them.
+    def run(self):
+        nextFlush = time.time() + self.flushInterval
+        while not self.stopping:
+            try:
+                batch = [self.queue.get(timeout=max(0, nextFlush - time.time()))]
+            except queue.Empty:
+                batch = []
+            # Detections are merged in batches to take the lock once per batch.
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                self.stopping = True
+                batch = [item for item in batch if item is not None]
+            try:
+                with self.lock:
+                    for item in batch:
+                        self.merge(*item)
+            except Exception:
+                self.logError()
+            if self.stopping or time.time() >= nextFlush:
+                self.tryFlush()
+                nextFlush = time.time() + self.flushInterval
+
+    # Adds a detection to the ring buffer, writing out the oldest record if the buffer is full.
+    def merge(self, stream, trackId, payload, codeType, polygon, timestamp):
+        key = (stream, trackId, payload)
+        record = self.records.get(key)
+        if record is None:
+            record = DetectionRecord(stream, trackId, payload, codeType, timestamp, timestamp, polygon)
+        else:
+            record = record._replace(lastSeen=max(record.lastSeen, timestamp))
+        self.records[key] = record
+        self.records.move_to_end(key)
+        self.dirty.add(key)
+        if len(self.records) > self.capacity:
+            # The oldest record is written out before it leaves the ring buffer. If that fails,
+            # it stays in memory until a later flush succeeds.
+            oldest = next(iter(self.records))
+            if oldest in self.dirty:
+                try:
+                    self.write([oldest])
+                except sqlite3.Error:
+                    self.logError()
+                    return
+            del self.records[oldest]
+
+    # Writes the given records. Records stay dirty unless the write is committed.
+    def write(self, keys):
+        rows = [self.records[k][:6] + (json.dumps(self.records[k].polygon),) for k in keys]
+        try:
+            # A record may have left the ring buffer and been seen again, so rows are merged rather than replaced.
+            self.db.executemany('INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?) '
+                                'ON CONFLICT (stream, trackId, payload) DO UPDATE SET '
+                                'firstSeen = min(firstSeen, excluded.firstSeen), lastSeen = max(lastSeen, excluded.lastSeen)', rows)
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            raise
+        self.dirty.difference_update(keys)
+
+    # Flushes from the writer thread, where an error must not stop the thread.
+    def tryFlush(self):
+        try:
+            self.flush()
+        except Exception:
+            self.logError()
+
+    def logError(self):
+        print("Error: Unable to write detections, they will be retried")
+        traceback.print_exc()
+
+    # Writes every changed record to the database.
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.write(list(self.dirty))
+
+    # Stops the writer thread after writing every queued detection.
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.tryFlush()
+        self.db.close()
+
+    # Returns the detections that were in view during the given time range.
+    # @param start The earliest time, in seconds since the epoch. None for no limit.
+    # @param end The latest time, in seconds since the epoch. None for no limit.
+    # @param payload Only return detections of this payload if given.
+    # @param stream Only return detections on this stream if given.
+    # @param limit The maximum number of records returned, most recent first.
+    # @return A list of DetectionRecords.
+    def query(self, start = None, end = None, payload = None, stream = None, limit = 1000):
+        where, params = self.filters(start, end, payload, stream)
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM detections' + where + ' ORDER BY lastSeen DESC LIMIT ?', params + [limit]).fetchall()
+        return [DetectionRecord(*row[:6], json.loads(row[6])) for row in rows]
+
+    # Counts the unique payloads seen in each time bucket of the given range. A track is
+    # counted in every bucket its [firstSeen, lastSeen] range overlaps, clamped to the range.
+    # @param start The earliest time, in seconds since the epoch. None for no limit.
+    # @param end The latest time, in seconds since the epoch. None for no limit.
+    # @param bucket The size of each bucket in seconds.
+    # @param stream Only count detections on this stream if given.
+    # @return A list of (bucket start time, number of unique payloads, number of detections) tuples.
+    def uniquePayloads(self, start = None, end = None, bucket = 3600, stream = None):
+        where, params = self.filters(start, end, None, stream)
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT payload, firstSeen, lastSeen FROM detections' + where, params).fetchall()
+        payloads, counts = {}, {}
+        for payload, firstSeen, lastSeen in rows:
+            first = int(max(firstSeen, start) // bucket) if start is not None else int(firstSeen // bucket)
+            last = int(min(lastSeen, end) // bucket) if end is not None else int(lastSeen // bucket)
+            for b in range(first, last + 1):
+                payloads.setdefault(b, set()).add(payload)
+                counts[b] = counts.get(b, 0) + 1
+        return [(b * bucket, len(payloads[b]), counts[b]) for b in sorted(counts)]
+
+    def filters(self, start, end, payload, stream):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append('lastSeen >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append('firstSeen <= ?')
+            params.append(end)
+        if payload is not None:
+            clauses.append('payload = ?')
+            params.append(payload)
+        if stream is not None:
+            clauses.append('stream = ?')
+            params.append(stream)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+    # Answers a query from the HTTP API.
+    # @param args A dictionary-like object mapping query argument names to strings. Accepts
+    # start, end, payload, stream, limit and groupBy, which is a bucket name or a number of seconds.
+    # @return A dictionary to be returned as JSON.
+    def api(self, args):
+        try:
+            start = float(args['start']) if args.get('start') else None
+            end = float(args['end']) if args.get('end') else None
+            limit = int(args.get('limit') or 1000)
+            groupBy = args.get('groupBy')
+            bucket = (buckets.get(groupBy) or int(groupBy)) if groupBy else None
+        except ValueError:
+            return {'resultStatus': 'FAILURE', 'data': "Invalid query arguments"}
+        try:
+            if bucket is not None:
+                if bucket <= 0:
+                    return {'resultStatus': 'FAILURE', 'data': "Invalid query arguments"}
+                rows = self.uniquePayloads(start, end, bucket, args.get('stream'))
+                data = [{'start': b, 'uniquePayloads': u, 'detections': n} for b, u, n in rows]
+            else:
+                data = [r._asdict() for r in self.query(start, end, args.get('payload'), args.get('stream'), limit)]
+        except sqlite3.Error as e:
+            return {'resultStatus': 'FAILURE', 'data': "Database error: {}".format(e)}
+        return {'resultStatus': 'SUCCESS', 'data': data, 'dropped': self.dropped}
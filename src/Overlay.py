@@ -0,0 +1,155 @@
+import cv2
+import numpy as np
+from collections import OrderedDict
+
+# Font parameters used for every label drawn over a frame.
+labelFont = cv2.FONT_HERSHEY_SIMPLEX
+labelScale = 0.5
+labelThickness = 2
+# Maximum pixel width of a label. Longer payloads are truncated with an ellipsis.
+labelMaxWidth = 320
+ellipsis = "..."
+
+# Measures the pixel width of the given text using the label font.
+# @param text The string to be measured.
+# @return The integer width of the text in pixels.
+def textWidth(text):
+    (w, h), baseline = cv2.getTextSize(text, labelFont, labelScale, labelThickness)
+    return w
+
+# Truncates text so that it fits within maxWidth pixels when drawn with the label font.
+# Uses a binary search over the prefix length, since getTextSize is monotonic in it.
+# @param text The string to be truncated.
+# @param maxWidth The maximum pixel width allowed for the text.
+# @return The text itself if it fits, otherwise the longest prefix that fits followed by an ellipsis.
+def truncateText(text, maxWidth = labelMaxWidth):
+    if textWidth(text) <= maxWidth:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if textWidth(text[:mid] + ellipsis) <= maxWidth:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + ellipsis
+
+# A pre-rasterized label. Stores the color of the text, an alpha mask of the
+# glyphs and the offset from the top of the sprite to the text baseline.
+class LabelSprite:
+
+    # Rasterizes the given text once so it can be blitted onto many frames.
+    # @param text The string to be rasterized. It is truncated to labelMaxWidth.
+    # @param color A tuple storing the BGR value of the text.
+    def __init__(self, text, color):
+        self.text = truncateText(text)
+        self.color = np.array(color, dtype=np.uint16)
+        (w, h), baseline = cv2.getTextSize(self.text, labelFont, labelScale, labelThickness)
+        # Room is left around the glyphs for the stroke thickness and descenders.
+        pad = labelThickness
+        self.baseline = h + pad
+        self.alpha = np.zeros((h + baseline + 2 * pad, w + 2 * pad), dtype=np.uint8)
+        cv2.putText(self.alpha, self.text, (pad, self.baseline), labelFont, labelScale, 255, labelThickness, cv2.LINE_AA)
+        self.alpha16 = self.alpha.astype(np.uint16)[:, :, None]
+
+    # Alpha-blends the sprite onto the image so that its baseline starts at point.
+    # The sprite is clipped to the bounds of the image.
+    # @param img The frame the label will be drawn on.
+    # @param point A tuple indicating the coordinate of the start of the text baseline.
+    def blit(self, img, point):
+        spriteH, spriteW = self.alpha.shape
+        x0, y0 = int(point[0]), int(point[1]) - self.baseline
+        imgH, imgW = img.shape[:2]
+        left, top = max(x0, 0), max(y0, 0)
+        right, bottom = min(x0 + spriteW, imgW), min(y0 + spriteH, imgH)
+        if left >= right or top >= bottom:
+            return
+        roi = img[top:bottom, left:right]
+        a = self.alpha16[top - y0:bottom - y0, left - x0:right - x0]
+        roi[:] = ((roi * (255 - a) + self.color * a) // 255).astype(np.uint8)
+
+# A bounded cache of label sprites keyed by text and color. Since the label of a
+# tracked code does not change between frames, each track is rasterized only once.
+class LabelCache:
+
+    # Initializes the LabelCache class.
+    # @param maxSize The maximum number of sprites kept. The least recently used sprite is evicted first.
+    def __init__(self, maxSize = 64):
+        self.maxSize = maxSize
+        self.sprites = OrderedDict()
+
+    # Returns the sprite for the given text, rasterizing it if it is not cached.
+    # @param text The string to be displayed.
+    # @param color A tuple storing the BGR value of the text.
+    # @return A LabelSprite for the text.
+    def get(self, text, color):
+        key = (text, tuple(color))
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            sprite = LabelSprite(text, color)
+            self.sprites[key] = sprite
+            if len(self.sprites) > self.maxSize:
+                self.sprites.popitem(last=False)
+        else:
+            self.sprites.move_to_end(key)
+        return sprite
+
+# A list of drawing operations recorded while a frame is processed. The source
+# frame is left untouched; the operations are replayed only when the frame is
+# drawn for display or encoded for streaming.
+class Overlay:
+
+    # Initializes the Overlay class with no drawing operations.
+    def __init__(self):
+        self.polygons = []
+        self.labels = []
+        self.dots = []
+
+    # Returns True if no drawing operations have been recorded.
+    def isEmpty(self):
+        return not (self.polygons or self.labels or self.dots)
+
+    # Records a closed polygon.
+    # @param points A 2d array containing the coordinates for each of the points.
+    # @param color A tuple storing the BGR value of the lines.
+    # @param thickness The integer thickness of the lines.
+    def addPolygon(self, points, color, thickness = 2):
+        self.polygons.append((np.array(points, dtype=np.int32).reshape(-1, 1, 2), color, thickness))
+
+    # Records a pre-rasterized label.
+    # @param sprite The LabelSprite to be drawn.
+    # @param point A tuple indicating the coordinate of the start of the text baseline.
+    def addLabel(self, sprite, point):
+        self.labels.append((sprite, point))
+
+    # Records a filled circle.
+    # @param center A tuple indicating the coordinate of the center of the circle.
+    # @param radius The integer radius of the circle.
+    # @param color A tuple storing the BGR value of the circle.
+    def addDot(self, center, radius, color):
+        self.dots.append((tuple(center), radius, color))
+
+    # Replays the recorded operations onto the given image in place.
+    # @param img The frame the overlay will be drawn on.
+    # @return The same frame, for convenience.
+    def draw(self, img):
+        for pts, color, thickness in self.polygons:
+            cv2.polylines(img, [pts], True, color, thickness)
+        for sprite, point in self.labels:
+            sprite.blit(img, point)
+        for center, radius, color in self.dots:
+            cv2.circle(img, center, radius, color, -1)
+        return img
+
+    # Composes the overlay with a frame without modifying the frame.
+    # @param frame The source frame.
+    # @param out An optional array with the same shape as frame to compose into.
+    # @return The frame itself if the overlay is empty, otherwise a composed copy.
+    def compose(self, frame, out = None):
+        if self.isEmpty():
+            return frame
+        if out is None or out.shape != frame.shape:
+            out = frame.copy()
+        else:
+            np.copyto(out, frame)
+        return self.draw(out)
@@ -0,0 +1,192 @@
+import cv2
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from .BufferPool import BufferPool
+
+# A stream variant describes how frames are encoded for a viewer.
+# @param height The maximum pixel height of the frame. None keeps the camera resolution.
+# @param quality The JPEG quality, between 1 and 100.
+# @param maxFps The maximum number of frames per second sent to the viewer.
+StreamVariant = namedtuple('StreamVariant', ['height', 'quality', 'maxFps'])
+
+# Named variants that can be requested with ?variant=<name>, ordered from best to worst.
+# The automatic mode moves a viewer along this ladder.
+variantLadder = [
+    ('1080p', StreamVariant(1080, 85, 30)),
+    ('720p', StreamVariant(720, 80, 25)),
+    ('480p', StreamVariant(480, 70, 15)),
+    ('360p', StreamVariant(360, 60, 10)),
+    ('240p', StreamVariant(240, 50, 5)),
+]
+presets = dict(variantLadder)
+presets['full'] = StreamVariant(None, 95, 30)
+defaultVariant = presets['full']
+
+# Heights and JPEG qualities a viewer can ask for. Requested values are snapped to
+# these steps, so viewers can only create a small, fixed number of encodings per frame.
+heightSteps = sorted(v.height for name, v in variantLadder)
+qualitySteps = sorted(set(v.quality for v in presets.values()))
+
+# Parses an integer query argument and clamps it to the given range.
+# @return The clamped integer, or default if the argument is missing or invalid.
+def clampArg(args, name, default, low, high):
+    try:
+        value = int(args.get(name))
+    except (TypeError, ValueError):
+        return default
+    return max(low, min(high, value))
+
+# Snaps an integer query argument to the nearest of the given steps.
+# @return The nearest step, or default if the argument is missing or invalid.
+def snapArg(args, name, default, steps):
+    try:
+        value = int(args.get(name))
+    except (TypeError, ValueError):
+        return default
+    return min(steps, key=lambda step: abs(step - value))
+
+# Reads the stream variant requested by a viewer. ?variant= selects a preset or
+# "auto", and ?height=, ?quality= and ?fps= override the fields of the preset. Heights
+# and qualities are snapped to heightSteps and qualitySteps.
+# @param args A dictionary-like object mapping query argument names to strings.
+# @return The requested StreamVariant and a boolean that is True if automatic mode was
+# requested, in which case the variant is None and an AdaptiveVariant chooses it.
+def parseVariant(args):
+    name = args.get('variant', '')
+    if name == 'auto':
+        return None, True
+    variant = presets.get(name, defaultVariant)
+    variant = StreamVariant(snapArg(args, 'height', variant.height, heightSteps),
+                            snapArg(args, 'quality', variant.quality, qualitySteps),
+                            clampArg(args, 'fps', variant.maxFps, 1, 30))
+    return variant, False
+
+# The key under which frames encoded for a variant are shared. Viewers that only
+# differ in maxFps receive the same encoded frames.
+def encodingKey(variant):
+    return (variant.height, variant.quality)
+
+# Encodes a frame as a multipart JPEG chunk for the given variant. Frames are
+# only ever scaled down, never up.
+# @param frame The frame to be encoded, with any overlay already composed.
+# @param variant The StreamVariant to encode for.
+# @return The bytes of the multipart chunk, or None if encoding failed.
+def encodeVariant(frame, variant):
+    frameH, frameW = frame.shape[:2]
+    if variant.height is not None and variant.height < frameH:
+        width = max(1, frameW * variant.height // frameH)
+        frame = cv2.resize(frame, (width, variant.height), interpolation=cv2.INTER_AREA)
+    flag, encodedFrame = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, variant.quality])
+    if not flag:
+        return None
+    return b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + encodedFrame.tobytes() + b'\r\n'
+
+# Holds the latest frame and encodes it lazily, at most once per variant. Viewer
+# threads that ask for the same variant of the same frame share one encoding.
+class EncodedFrameCache:
+
+    # Initializes the EncodedFrameCache class with no frame.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.frame = None
+        self.overlay = None
+        self.results = {}
+        # True once capture has stopped, until it is started again.
+        self.closed = False
+        # Composed frames are written into a ring of pooled buffers.
+        self.pool = BufferPool()
+
+    # Replaces the latest frame and wakes up viewers waiting for it.
+    # @param frame The captured frame. It must not be modified afterwards.
+    # @param overlay The Overlay to be composed with the frame when it is encoded.
+    def publish(self, frame, overlay):
+        with self.condition:
+            self.seq += 1
+            self.frame, self.overlay = frame, overlay
+            self.results = {}
+            self.condition.notify_all()
+
+    # Marks the cache as receiving frames again, before capture is started.
+    def open(self):
+        with self.condition:
+            self.closed = False
+
+    # Tells every waiting viewer that no more frames will be published.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # Blocks until a frame newer than seq has been published or the cache is closed.
+    # @param seq The sequence number of the last frame the viewer received.
+    # @param timeout The maximum number of seconds to wait.
+    # @return True if a newer frame is available or the cache was closed.
+    def wait(self, seq, timeout = None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.seq != seq or self.closed, timeout)
+
+    # Computes a value once per frame. The first caller computes it, later callers
+    # wait for and share the result.
+    def once(self, results, key, compute):
+        with self.condition:
+            future = results.get(key)
+            owner = future is None
+            if owner:
+                future = results[key] = Future()
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    # Returns the latest frame encoded for the given variant.
+    # @param variant The StreamVariant to encode for.
+    # @return The sequence number of the frame and its encoded bytes, or None for the bytes if there is no frame.
+    def get(self, variant):
+        with self.condition:
+            seq, frame, overlay, results = self.seq, self.frame, self.overlay, self.results
+        if frame is None:
+            return seq, None
+        composed = self.once(results, 'composed', lambda: overlay.compose(frame, self.pool.next('composed', frame.shape)))
+        return seq, self.once(results, encodingKey(variant), lambda: encodeVariant(composed, variant))
+
+# Chooses a variant for a viewer in automatic mode. When sending a frame takes
+# longer than the frame interval, the viewer's send buffer is backing up and the
+# viewer is moved down the ladder. After a run of fast sends it is moved back up.
+class AdaptiveVariant:
+
+    # Initializes the AdaptiveVariant class.
+    # @param level The starting index in variantLadder.
+    # @param upgradeAfter The number of consecutive fast sends needed to move up the ladder.
+    def __init__(self, level = 1, upgradeAfter = 50):
+        self.level = level
+        self.upgradeAfter = upgradeAfter
+        self.fastSends = 0
+
+    # The StreamVariant currently chosen for the viewer.
+    @property
+    def variant(self):
+        return variantLadder[self.level][1]
+
+    # Records how long a frame took to send and adjusts the variant.
+    # @param seconds The time spent sending the last frame.
+    # @return True if the variant changed.
+    def report(self, seconds):
+        budget = 1.0 / self.variant.maxFps
+        if seconds > budget:
+            self.fastSends = 0
+            if self.level < len(variantLadder) - 1:
+                self.level += 1
+                return True
+        elif seconds < budget / 4:
+            self.fastSends += 1
+            if self.fastSends >= self.upgradeAfter and self.level > 0:
+                self.fastSends = 0
+                self.level -= 1
+                return True
+        else:
+            self.fastSends = 0
+        return False
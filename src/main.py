@@ -7,7 +7,12 @@ import validators
 import hashlib
 import os.path
 from os import path
+from functools import lru_cache
+from collections import namedtuple
 from .LinkPreviewGenerator import generateLinkPreview
+from .Overlay import Overlay, LabelCache
+from .BufferPool import BufferPool
+from .Camera import Camera
 
 # Tuples storing green and blue BGR values.
 green = (77, 202, 4)
@@ -22,6 +27,32 @@ optFlowParams = dict(winSize = (85,85),
                      maxLevel = 4,
                      criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 100, 0.03))
 
+# A code in view on a processed frame.
+# @param trackId The integer ID of the track. A code keeps its ID while it stays in view.
+# @param data The string data retrieved from the code.
+# @param text The text displayed above the code.
+# @param points A 2d array containing the coordinates for each of the points of the code.
+# @param tracked A boolean that is True if the code was followed with optical flow instead of detected.
+Track = namedtuple('Track', ['trackId', 'data', 'text', 'points', 'tracked'])
+
+# The result of processing a frame.
+# @param frame The frame, including any AR previews. Display boxes are not drawn on it.
+# @param overlay The Overlay holding the display boxes and status dot.
+# @param tracks A list of the Tracks in view.
+# @param status "detected" if codes were decoded, "tracked" if they were followed with optical flow, otherwise None.
+# @param timings A dictionary mapping each processing stage to the seconds spent in it.
+FrameResult = namedtuple('FrameResult', ['frame', 'overlay', 'tracks', 'status', 'timings'])
+
+# Cache of pre-rasterized labels shared by every display box.
+labelCache = LabelCache()
+
+# Side length in pixels of the square patch a tracked code is rectified to before it is re-decoded.
+rectifiedSize = 160
+# Fraction of the patch left blank around the code, since decoders need a quiet zone.
+quietZone = 0.15
+# Smallest area in square pixels of a followed code that is worth re-decoding.
+minQuadArea = 100
+
 # Given a list of four points, returns a tuple containing
 # the integer coordinate of the center of the points.
 # @param points A 2d array containing the coordinates for each of the four points.
@@ -40,20 +71,21 @@ def findTextPoint(points):
     return (x, y - 10)
 
 # Draws a display box with text around the given points in the image.
-# @param img The frame the display box will be depicted on.
+# @param img The frame the display box will be depicted on, or an Overlay to record the display box in.
 # @param points A 2d array containing the coordinates for each of the four points.
 # @param text The text to be displayed on the top of the display box. If empty, no text will be displayed.
 def displayBox(img, points, text = ""):
-    n = len(points)
+    overlay = img if isinstance(img, Overlay) else Overlay()
+    overlay.addPolygon(points, green, 2)
     
-    for i in range(n):
-        cv2.line(img, tuple(points[i]), tuple(points[(i+1) % n]), green, 2)
-        
     if text != "":
-        cv2.putText(img, text, findTextPoint(points), cv2.FONT_HERSHEY_SIMPLEX, 0.5, green, 2)
+        overlay.addLabel(labelCache.get(text, green), findTextPoint(points))
         
     # Putting a dot in the middle
-    cv2.circle(img, findCenter(points), 2, green, -1)
+    overlay.addDot(findCenter(points), 2, green)
+    
+    if overlay is not img:
+        overlay.draw(img)
 
 # Finds the angle between two vectors in radians.
 # @param vector1 A NumPy vector storing the value of an edge of the display box.
@@ -96,6 +128,23 @@ def isRectangle(points):
     
     return interiorAngles and oppositeAngles
 
+# Finds if the points given form a convex quadrilateral of a sane size compared to the
+# previous points of the same code. Much looser than isRectangle, so codes seen at steep
+# angles can still be re-decoded; a successful decode confirms the shape.
+# @param points A 2d array containing the coordinates for each of the four points.
+# @param prevPoints A 2d array containing the previous coordinates of the code.
+# @return A boolean indicating if the points could be the corners of the code.
+def isPlausibleQuad(points, prevPoints):
+    if len(points) != 4:
+        return False
+    contour = np.array(points, dtype=np.float32).reshape(-1, 1, 2)
+    if not cv2.isContourConvex(contour):
+        return False
+    area = cv2.contourArea(contour)
+    prevArea = cv2.contourArea(np.array(prevPoints, dtype=np.float32).reshape(-1, 1, 2))
+    # The code may shrink a lot when turned away, but it cannot vanish or blow up.
+    return area >= minQuadArea and prevArea / 10 <= area <= prevArea * 4
+
 # Creates a sha1 hash string for the given string.
 # @param s The string to be encoded.
 # @return A sha1 hash string corresponding to string s.
@@ -138,22 +187,57 @@ def coordinatesInRange(x, y, pts):
     yInRange = y >= min(yVals) and y <= max(yVals)
     return xInRange and yInRange
 
+# Orders four points by corner, going clockwise around their center starting from the top left.
+# The order stays consistent for codes that are rotated or seen at steep angles.
+# @param pts A 2d array containing the coordinates for each of the four points.
+# @return A tuple of NumPy vectors for the top left, top right, bottom right and bottom left corners.
+def orderCorners(pts):
+    pts = np.array(pts, dtype=np.float32)
+    center = pts.mean(axis=0)
+    # Angles grow clockwise on screen since the y-axis points down.
+    pts = pts[np.argsort(np.arctan2(pts[:, 1] - center[1], pts[:, 0] - center[0]))]
+    start = int(np.argmin(pts[:, 0] + pts[:, 1]))
+    pts = np.roll(pts, -start, axis=0)
+    return pts[0], pts[1], pts[2], pts[3]
+
+# Warps the region of a tracked code to a small, square, contrast-normalized patch
+# so it can be decoded again without decoding the full frame.
+# @param gray The grayscale frame containing the code.
+# @param pts A 2d array containing the coordinates for each of the four points of the code.
+# @param size The side length in pixels of the patch.
+# @return A grayscale patch with the code upright in its center.
+def rectifyCode(gray, pts, size = rectifiedSize):
+    # sourceMatrix: The corners of the code in the frame.
+    sourceMatrix = np.array(orderCorners(pts), dtype=np.float32)
+    # destinationMatrix: The corners of the code in the patch, inset by the quiet zone.
+    lo, hi = size * quietZone, size * (1 - quietZone)
+    destinationMatrix = np.array([[lo, lo], [hi, lo], [hi, hi], [lo, hi]], dtype=np.float32)
+    
+    h = cv2.getPerspectiveTransform(sourceMatrix, destinationMatrix)
+    patch = cv2.warpPerspective(gray, h, (size, size), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return cv2.normalize(patch, None, 0, 255, cv2.NORM_MINMAX)
+
+# Loads an image preview from disk. Previews are kept in memory since the same
+# preview is shown on every frame while its code is in view.
+# @param path The path of the image preview.
+# @return The image preview as a BGR NumPy array.
+@lru_cache(maxsize=16)
+def loadPreview(path):
+    return cv2.imread(path)
+
 # Makes a new frame including an augmented reality preview for a given code.
 # @param frame The frame to be used to create the new augmented reality frame.
 # @param pts A 2d array containing the coordinates for each of the four points of the given code.
 # @param path The path to find the created image preview for the code that is located by pts.
 # @param imgWidth Width of the image frame
 # @param imgHeight Height of the image frame
+# @param out An optional array with the same shape as frame to write the new frame into. It may be frame itself.
 # @return A new frame with the image preview placed below the given code.
-def makeARPreviewFrame(frame, pts, path, imgWidth, imgHeight):
-    source = cv2.imread(path)
+def makeARPreviewFrame(frame, pts, path, imgWidth, imgHeight, out=None):
+    source = loadPreview(path)
     srcH, srcW = source.shape[:2]
-    pts = sorted(pts, key=lambda x: x[0])
-    # Organizing the points given by corner: top left, bottom left, top right, bottom right.
-    ptTL = min(pts[:2], key=lambda x: x[1])
-    ptBL = max(pts[:2], key=lambda x: x[1])
-    ptTR = min(pts[2:], key=lambda x: x[1])
-    ptBR = max(pts[2:], key=lambda x: x[1])
+    # Organizing the points given by corner: top left, top right, bottom right, bottom left.
+    ptTL, ptTR, ptBR, ptBL = orderCorners(pts)
     
     centerPt = (np.array(ptBR) + np.array(ptBL)) / 2
     lrDisplacement = (np.array(ptBR) - np.array(ptBL)) * 2
@@ -173,20 +257,15 @@ def makeARPreviewFrame(frame, pts, path, imgWidth, imgHeight):
     sourceMatrix = np.array([[0, 0], [srcW, 0], [srcW, srcH], [0, srcH]])
     
     h, status = cv2.findHomography(sourceMatrix, destinationMatrix)
-    warp = cv2.warpPerspective(source, h, (imgWidth, imgHeight))
-    
-    mask = np.zeros((imgHeight, imgWidth), dtype="uint8")
-    cv2.fillConvexPoly(mask, destinationMatrix.astype("int32"), (255, 255, 255), cv2.LINE_AA)
-    
-    scaledMask = mask.copy() / 255.0
-    scaledMask = np.dstack([scaledMask] * 3)
     
-    warpMultiplied = cv2.multiply(warp.astype("float"), scaledMask)
-    imgMultiplied = cv2.multiply(frame.astype("float"), 1.0 - scaledMask)
-    
-    returnFrame = cv2.add(warpMultiplied, imgMultiplied)
-    returnFrame = returnFrame.astype("uint8")
-    return returnFrame
+    if out is None:
+        out = frame.copy()
+    elif out is not frame:
+        np.copyto(out, frame)
+    # With a transparent border, pixels outside the warped preview keep the values
+    # of the frame, so no full-frame mask or float images are needed.
+    cv2.warpPerspective(source, h, (imgWidth, imgHeight), dst=out, borderMode=cv2.BORDER_TRANSPARENT)
+    return out
 
 # Formats data into a valid url
 # @param data A string containing data from a QR code
@@ -197,124 +276,293 @@ def format_data(data):
     return data
 
 class ImageProcessor():
-    def __init__(self):
+    # Initializes the ImageProcessor class.
+    # @param detectionLog An optional DetectionLog that every decoded code is recorded in.
+    # @param stream A string naming the camera the frames come from, used in the detection log.
+    def __init__(self, detectionLog=None, stream="camera"):
         # Boolean value storing if a code has been detected recently.
         self.qrExists = False
         # Time object denoting the last time a code has been detected.
         self.lastSeen = None
         # List storing previously found points for codes, used in the optical flow algorithm.
         self.prevPoints = []
-        # Object storing the last frame when a code was detected.
-        self.prevImage = None
+        # Grayscale copy of the last frame when a code was detected. Only the grayscale
+        # image is needed for optical flow, so the color frame is not kept.
+        self.prevGray = None
+        # Index of the grayscale buffer the next frame is converted into. The two
+        # buffers alternate so the current frame never overwrites prevGray.
+        self.grayIndex = 0
+        # Preallocated arrays reused across frames.
+        self.pool = BufferPool()
+        # The buffer holding this frame's AR previews, if any have been drawn.
+        self.arFrame = None
         # List storing the formatted text values of previously detected codes for display purposes.
         self.prevText, self.prevData = [], []
+        # List storing the track IDs of previously detected codes. A code keeps its ID while it stays in view.
+        self.prevTrackIds = []
+        # Integer storing the ID given to the next new track. Track IDs continue from
+        # earlier runs, so records of different runs are never merged in the log.
+        self.nextTrackId = 0 if detectionLog is None else detectionLog.nextTrackId(stream)
         # Set storing data values that augmented reality previews will be generated for.
         self.showPreview = set()
+        self.detectionLog = detectionLog
+        self.stream = stream
+        # List storing the codes shown on the last processed frame, used for hit-testing.
+        self.tracks = []
+    
+    # Returns an ID for a new track.
+    def newTrackId(self):
+        trackId = self.nextTrackId
+        self.nextTrackId += 1
+        return trackId
+    
+    # Records a decoded code in the detection log, if there is one.
+    # @param j The index of the code in the "prev" lists.
+    # @param codeType The type of the code.
+    # @param points A 2d array containing the coordinates for each of the points of the code.
+    def logDetection(self, j, codeType, points):
+        if self.detectionLog is not None:
+            self.detectionLog.record(self.stream, self.prevTrackIds[j], self.prevData[j], codeType, points)
+    
+    # Converts the frame to grayscale into a pooled buffer.
+    # @param frame The BGR or grayscale image frame.
+    # @return The grayscale frame.
+    def grayscale(self, frame):
+        gray = self.pool.get(("gray", self.grayIndex), frame.shape[:2])
+        if frame.ndim == 2:
+            np.copyto(gray, frame)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+        return gray
+    
+    # Keeps the grayscale frame as the history used for tracking.
+    # @param gray The grayscale frame returned by grayscale().
+    def keepHistory(self, gray):
+        if self.prevGray is not gray:
+            self.prevGray = gray
+            self.grayIndex ^= 1
+    
+    # Adds the AR preview for a code to the frame. Previews are drawn into a ring of
+    # pooled buffers, since the returned frame may still be read by an encoder.
+    # @param frame The frame the preview is added to.
+    # @param pts A 2d array containing the coordinates for each of the four points of the code.
+    # @param data The string data retrieved from the code.
+    # @return The frame including the preview.
+    def addPreview(self, frame, pts, data):
+        imgWidth, imgHeight = frame.shape[1], frame.shape[0]
+        # Several previews on one frame are drawn into the same buffer.
+        if frame is not self.arFrame:
+            self.arFrame = self.pool.next("ar", frame.shape)
+        return makeARPreviewFrame(frame, pts, makePreview(data), imgWidth, imgHeight, self.arFrame)
         
-    # Processes a single frame and returns the new frame with 
-    # a display if a QR code is detected
+    # Clears every tracked code after the optical flow timeout.
+    def reset(self):
+        self.qrExists = False
+        self.lastSeen = None
+        self.prevPoints.clear()
+        self.prevText.clear()
+        self.prevData.clear()
+        self.prevTrackIds.clear()
+        self.prevGray = None
+    
+    # Replaces the "prev" lists with the given tracks.
+    # @param tracks A list of Tracks.
+    def remember(self, tracks):
+        self.prevPoints[:] = [t.points for t in tracks]
+        self.prevText[:] = [t.text for t in tracks]
+        self.prevData[:] = [t.data for t in tracks]
+        self.prevTrackIds[:] = [t.trackId for t in tracks]
+    
+    # Follows a previously detected code into the current frame with optical flow.
+    # @param gray The grayscale current frame.
+    # @param j The index of the code in the "prev" lists.
+    # @return The new points of the code, or None if they are not a plausible quad near the
+    # previous center. The points still need isRectangle or a decode to be displayed.
+    def followCode(self, gray, j):
+        point = self.prevPoints[j]
+        # Argument types are changed to fit the optical flow algorithm parameters.
+        p1 = [[[np.float32(i[0]), np.float32(i[1])]] for i in point]
+        p = np.array(p1)
+        
+        newPoints, status, error = cv2.calcOpticalFlowPyrLK(self.prevGray, gray, p, None, **optFlowParams)
+        
+        # Change the types of the points to fit the arguments of displayBox()
+        newPoints = [[int(i[0][0]), int(i[0][1])] for i in newPoints]
+        
+        # Computing the distance between center of old points and center of new points.
+        newCenter = np.array(findCenter(newPoints))
+        oldCenter = np.array(findCenter(point))
+        dist = np.linalg.norm(newCenter - oldCenter)
+        
+        noSuddenMovement = dist < 150
+        
+        # Only keep the code if there's no sudden change in placement and the shape is possible.
+        if noSuddenMovement and isPlausibleQuad(newPoints, point):
+            return newPoints
+        return None
+    
+    # Tries to decode a followed code again from a rectified patch. A rectified patch decodes
+    # at angles and distances where the full frame does not, for a fraction of the cost.
+    # @param gray The grayscale current frame.
+    # @param j The index of the code in the "prev" lists. Its data is refreshed if the decode succeeds.
+    # @param newPoints The points of the code in the current frame.
+    # @return A boolean indicating if the code was decoded.
+    def recoverCode(self, gray, j, newPoints):
+        recovered = pyzbar.decode(rectifyCode(gray, newPoints))
+        if len(recovered) == 0:
+            return False
+        data = recovered[0].data.decode("utf-8")
+        if data != self.prevData[j]:
+            # A different code took the place of the tracked one, so it starts a new track.
+            self.prevData[j] = data
+            self.prevText[j] = "{0}: {1}".format(recovered[0].type, data)
+            self.prevTrackIds[j] = self.newTrackId()
+        self.logDetection(j, recovered[0].type, newPoints)
+        return True
+    
+    # Processes a single frame. The frame is not drawn on: display boxes and the status
+    # dot are recorded in an overlay that front-ends draw or compose when needed.
     # @param frame The image frame to be processed
-    # @param AR A boolean storing if an AR preview should be added
-    # @return The processed frame, a boolean storing if a code 
-    # is found, and the data from the code
-    def processImage(self, frame, AR=False):
-        codes = pyzbar.decode(frame)
+    # @param AR A boolean storing if AR previews should be added for codes in showPreview
+    # @param overlay An optional Overlay to record display boxes in. A new one is made if not given.
+    # @return A FrameResult with the frame (a new frame if AR previews were added),
+    # the overlay, the codes in view and the time spent in each stage
+    def process(self, frame, AR=False, overlay=None):
+        startTime = time.perf_counter()
+        timings = {}
+        overlay = Overlay() if overlay is None else overlay
+        self.arFrame = None
+        tracks = []
+        status = None
+        # The grayscale frame is used both for decoding and for optical flow.
+        gray = self.grayscale(frame)
+        codes = pyzbar.decode(gray)
+        timings["decode"] = time.perf_counter() - startTime
+        
         if len(codes) == 0 and self.qrExists:
             # A code has been detected previously but is not found currently on this frame.
             # Optical flow will be used with the previously found points to draw detection boxes.
+            trackTime = time.perf_counter()
+            failed, recovered = False, False
             for j in range(len(self.prevPoints)):
-                point = self.prevPoints[j]
-                # Argument types are changed to fit the optical flow algorithm parameters.
-                p1 = [[[np.float32(i[0]), np.float32(i[1])]] for i in point]
-                p = np.array(p1)
-                f = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                pI = cv2.cvtColor(self.prevImage, cv2.COLOR_BGR2GRAY)
-                
-                newPoints, status, error = cv2.calcOpticalFlowPyrLK(pI, f, p, None, **optFlowParams)
-                
-                # Change the types of the points to fit the arguments of displayBox()
-                newPoints = [[int(i[0][0]), int(i[0][1])] for i in newPoints]
-                
-                # Computing the distance between center of old points and center of new points.
-                newCenter = np.array(findCenter(newPoints))
-                oldCenter = np.array(findCenter(self.prevPoints[j]))
-                dist = np.linalg.norm(newCenter - oldCenter)
-                
-                noSuddenMovement = dist < 150
-                    
-                # Only display the box if there's no sudden change in placement and the shape is correct.
-                if isRectangle(newPoints) and noSuddenMovement:
-                    if AR and self.prevData[j] in self.showPreview:
-                        imgWidth, imgHeight = frame.shape[1], frame.shape[2]
-                        frame = makeARPreviewFrame(frame, self.prevPoints[j], makePreview(self.prevData[j]), imgWidth, imgHeight)
-                        displayBox(frame, newPoints)
-                        return frame, True, self.prevData[j]
-                    else:
-                        displayBox(frame, newPoints, self.prevText[j])
-                        return frame, True, self.prevData[j]
-                    
-                # Optical flow times out after one full second of no code detection.
-                # QR code may no longer be in frame, time out and reset everything.
-                elif time.time() - self.lastSeen > 1:
-                    self.qrExists = False
-                    self.lastSeen = None
-                    self.prevPoints.clear()
-                    self.prevText.clear()
-                    self.prevData.clear()
-                    self.prevImage = None
+                newPoints = self.followCode(gray, j)
+                if newPoints is None:
+                    failed = True
+                    continue
+                # A decode confirms the quad. Without one, only parallelogram-shaped quads are shown.
+                if self.recoverCode(gray, j, newPoints):
+                    recovered = True
+                elif not isRectangle(newPoints):
+                    failed = True
+                    continue
+                tracks.append(Track(self.prevTrackIds[j], self.prevData[j], self.prevText[j], newPoints, True))
+            
+            if recovered:
+                # The codes are confirmed, so tracking restarts from this frame and the timeout is reset.
+                # Codes that could not be followed are dropped, since their points belong to the old frame.
+                self.lastSeen = time.time()
+                self.keepHistory(gray)
+                self.remember(tracks)
+            # Optical flow times out after one full second of no code detection.
+            # QR code may no longer be in frame, time out and reset everything.
+            elif failed and time.time() - self.lastSeen > 1:
+                self.reset()
+                tracks = []
+            if tracks:
+                status = "tracked"
+            timings["track"] = time.perf_counter() - trackTime
         
         # Codes have been detected, all "prev" variables can be updated.
         elif len(codes) > 0:
             self.qrExists = True
             self.lastSeen = time.time()
-            self.prevPoints.clear()
-            self.prevText.clear()
-            self.prevData.clear()
-            self.prevImage = frame
-        
+            self.keepHistory(gray)
+            # Codes that were already in view keep their track IDs. Several codes may share
+            # a payload, so each payload maps to the IDs and centers of all its tracks.
+            prevTracks = {}
+            for data, trackId, points in zip(self.prevData, self.prevTrackIds, self.prevPoints):
+                prevTracks.setdefault(data, []).append((trackId, np.array(findCenter(points))))
+            
             for code in codes:
-                points = code.polygon
-                self.prevPoints.append(points)
                 data = code.data.decode("utf-8")
-                codeType = code.type
-            
                 # Preparing text to be displayed. (Text shows type of code and the data associated with it)
-                text = "{0}: {1}".format(codeType, data)
-                self.prevText.append(text)
-                self.prevData.append(data)
-                # If the data needs to be showed in the AR preview, update the frame to include the preview.
-                # Performance is slower when AR previews need to be shown.
-                if AR and data in self.showPreview:
-                    imgWidth, imgHeight = frame.shape[1], frame.shape[2]
-                    frame = makeARPreviewFrame(frame, points, makePreview(data), imgWidth, imgHeight)
-                    displayBox(frame, points)
+                text = "{0}: {1}".format(code.type, data)
+                # The code takes over the nearest previous track with the same payload.
+                candidates = prevTracks.get(data)
+                if candidates:
+                    center = np.array(findCenter(code.polygon))
+                    nearest = min(candidates, key=lambda c: np.linalg.norm(c[1] - center))
+                    candidates.remove(nearest)
+                    trackId = nearest[0]
                 else:
-                    displayBox(frame, points, text)
-            return frame, True, self.prevData[0]
-        return frame, False, None
+                    trackId = self.newTrackId()
+                tracks.append(Track(trackId, data, text, code.polygon, False))
+            self.remember(tracks)
+            for j, code in enumerate(codes):
+                self.logDetection(j, code.type, code.polygon)
+            status = "detected"
+        
+        previewTime = time.perf_counter()
+        for track in tracks:
+            # If the data needs to be showed in the AR preview, update the frame to include the preview.
+            # Performance is slower when AR previews need to be shown.
+            if AR and track.data in self.showPreview:
+                frame = self.addPreview(frame, track.points, track.data)
+                displayBox(overlay, track.points)
+            else:
+                displayBox(overlay, track.points, track.text)
+        timings["preview"] = time.perf_counter() - previewTime
+        
+        # Blue dot in the top left of the screen flashes when a code is detected,
+        # green dot flashes when optical flow is used.
+        if status is not None:
+            overlay.addDot((10, 10), 5, blue if status == "detected" else green)
+        
+        self.tracks = tracks
+        timings["total"] = time.perf_counter() - startTime
+        return FrameResult(frame, overlay, tracks, status, timings)
+    
+    # Processes a single frame and returns the new frame with 
+    # a display if a QR code is detected
+    # @param frame The image frame to be processed
+    # @param AR A boolean storing if an AR preview should be added
+    # @param overlay An optional Overlay to record display boxes in. If given,
+    # boxes are not drawn onto the frame and can be composed at encode time.
+    # @return The processed frame, a boolean storing if a code 
+    # is found, and the data from the code
+    def processImage(self, frame, AR=False, overlay=None):
+        result = self.process(frame, AR, overlay)
+        if overlay is None:
+            result.overlay.draw(result.frame)
+        if not result.tracks:
+            return result.frame, False, None
+        return result.frame, True, result.tracks[0].data
+    
+    # Finds the code shown at the given coordinate in the last processed frame.
+    # @param x The integer for the x-coordinate.
+    # @param y The integer for the y-coordinate.
+    # @return The Track at the coordinate, or None if there is none.
+    def trackAt(self, x, y):
+        for track in self.tracks:
+            if coordinatesInRange(x, y, track.points):
+                return track
+        return None
+    
+    # Turns the AR preview for the given data on or off. The preview is generated when it is turned on.
+    # @param data The string data retrieved from a code.
+    def togglePreview(self, data):
+        if data in self.showPreview:
+            self.showPreview.remove(data)
+        else:
+            makePreview(data)
+            self.showPreview.add(data)
 
 # Main loop for the ARQR application
 def main():
-    # VideoCapture object that opens the default camera.
-    vidCap = cv2.VideoCapture(0)
-    # Boolean value storing if a code has been detected recently.
-    qrExists = False
-    # Time object denoting the last time a code has been detected.
-    lastSeen = None
-    # List storing previously found points for codes, used in the optical flow algorithm.
-    prevPoints = []
-    # Object storing the last frame when a code was detected.
-    prevImage = None
-    # List storing the formatted text values of previously detected codes for display purposes.
-    prevText = []
-    # List storing the data values of previously detected codes.
-    prevData = []
-    # Set storing data values that augmented reality previews will be generated for.
-    showPreview = set()
-    # Integer value storing the pixel width of the frame.
-    imgWidth = -1
-    # Integer value storing the pixel height of the frame.
-    imgHeight = -1
+    # Camera that reads frames from the default camera.
+    camera = Camera(0)
+    # Engine shared with the web server. It keeps the tracked codes between frames.
+    ip = ImageProcessor()
 
     # Reads mouse input to detect if a QR code box has been clicked on the display.
     # A left click opens a web browser window navigating to the QR code data.
@@ -326,110 +574,28 @@ def main():
     # @param param An optional parameter. Usually left as None.
     def clickQR(event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONDOWN:
-            n = len(prevPoints)
-            for i in range(n):
-                if coordinatesInRange(x, y, prevPoints[i]):
-                    webbrowser.open_new_tab(format_data(prevData[i]))
-                    return
+            track = ip.trackAt(x, y)
+            if track is not None:
+                webbrowser.open_new_tab(format_data(track.data))
         elif event == cv2.EVENT_RBUTTONDOWN:
-            n = len(prevPoints)
-            for i in range(n):
-                if coordinatesInRange(x, y, prevPoints[i]):
-                    if prevData[i] in showPreview:
-                        showPreview.remove(prevData[i])
-                        return
-                    else:
-                        makePreview(prevData[i])
-                        showPreview.add(prevData[i])
-                        return
+            track = ip.trackAt(x, y)
+            if track is not None:
+                ip.togglePreview(track.data)
 
-    if not vidCap.isOpened():
+    if not camera.isOpened():
         print("Error: Unable to open camera")
         
     else:
-        imgWidth = int(vidCap.get(3))
-        imgHeight = int(vidCap.get(4))
+        cv2.namedWindow("Display")
+        cv2.setMouseCallback("Display", clickQR)
         while True:
-            isRead, frame = vidCap.read()
+            frame = camera.read()
             
-            if isRead:
-                codes = pyzbar.decode(frame)
-                
-                if len(codes) == 0 and qrExists:
-                    # A code has been detected previously but is not found currently on this frame.
-                    # Optical flow will be used with the previously found points to draw detection boxes.
-                    for j in range(len(prevPoints)):
-                        point = prevPoints[j]
-                        # Argument types are changed to fit the optical flow algorithm parameters.
-                        p1 = [[[np.float32(i[0]), np.float32(i[1])]] for i in point]
-                        p = np.array(p1)
-                        f = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                        pI = cv2.cvtColor(prevImage, cv2.COLOR_BGR2GRAY)
-                        
-                        newPoints, status, error = cv2.calcOpticalFlowPyrLK(pI, f, p, None, **optFlowParams)
-                        
-                        # Change the types of the points to fit the arguments of displayBox()
-                        newPoints = [[int(i[0][0]), int(i[0][1])] for i in newPoints]
-                        
-                        # Computing the distance between center of old points and center of new points.
-                        newCenter = np.array(findCenter(newPoints))
-                        oldCenter = np.array(findCenter(prevPoints[j]))
-                        dist = np.linalg.norm(newCenter - oldCenter)
-                        
-                        noSuddenMovement = dist < 150
-                            
-                        # Only display the box if there's no sudden change in placement and the shape is correct.
-                        if isRectangle(newPoints) and noSuddenMovement:
-                            if prevData[j] in showPreview:
-                                frame = makeARPreviewFrame(frame, prevPoints[j], makePreview(prevData[j]), imgWidth, imgHeight)
-                                displayBox(frame, newPoints)
-                            else:
-                                displayBox(frame, newPoints, prevText[j])
-                            # Green dot in the top left of the screen flashes when optical flow is used.
-                            cv2.circle(frame, (10, 10), 5, green, -1)
-                            
-                        # Optical flow times out after one full second of no code detection.
-                        # QR code may no longer be in frame, time out and reset everything.
-                        elif time.time() - lastSeen > 1:
-                            qrExists = False
-                            lastSeen = None
-                            prevPoints.clear()
-                            prevText.clear()
-                            prevData.clear()
-                            prevImage = None
-                
-                # Codes have been detected, all "prev" variables can be updated.
-                elif len(codes) > 0:
-                    qrExists = True
-                    lastSeen = time.time()
-                    prevPoints.clear()
-                    prevText.clear()
-                    prevData.clear()
-                    prevImage = frame
-                
-                    for code in codes:
-                        points = code.polygon
-                        prevPoints.append(points)
-                        data = code.data.decode("utf-8")
-                        codeType = code.type
-                    
-                        # Preparing text to be displayed. (Text shows type of code and the data associated with it)
-                        text = "{0}: {1}".format(codeType, data)
-                        prevText.append(text)
-                        prevData.append(data)
-                        # If the data needs to be showed in the AR preview, update the frame to include the preview.
-                        # Performance is slower when AR previews need to be shown.
-                        if data in showPreview:
-                            frame = makeARPreviewFrame(frame, points, makePreview(data), imgWidth, imgHeight)
-                            displayBox(frame, points)
-                        else:
-                            displayBox(frame, points, text)
-                    
-                    # Blue dot in the top left of the screen flashes when a code is detected.
-                    cv2.circle(frame, (10, 10), 5, blue, -1)
-                
-                cv2.imshow("Display", frame)
-                cv2.setMouseCallback("Display", clickQR)
+            if frame is not None:
+                # AR previews are always enabled on the desktop and toggled per code with a right click.
+                result = ip.process(frame, True)
+                # The frame is not shared with anything else, so the overlay is drawn onto it directly.
+                cv2.imshow("Display", result.overlay.draw(result.frame))
                 key = cv2.waitKey(1)
             
                 # Loop times out when the 'q' key on the keyboard is pressed.
@@ -438,9 +604,9 @@ def main():
             else:
                 break
         
-    vidCap.release()
+    camera.release()
     cv2.destroyAllWindows()
     print("Done")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()